@@ -7,142 +7,256 @@ import os
 import subprocess
 import json
 import re
-from pathlib import Path
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # orjson decodes large lsblk output considerably faster; its
+    # JSONDecodeError subclasses json.JSONDecodeError
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 
 class NVMeHandler:
     """Handles NVMe partition detection and validation"""
     
+    # Common bootable filesystem types
+    _BOOTABLE_FS = frozenset({'fat32', 'vfat', 'fat16', 'ntfs', 'ext2', 'ext3', 'ext4', 'btrfs', 'xfs'})
+    _EFI_FS = frozenset({'fat32', 'vfat'})
+    
+    # Common boot partition labels
+    _BOOT_LABEL_RE = re.compile(r'boot|efi|system|recovery|windows|linux')
+    
+    # NVMe namespace (group 1) with optional partition suffix (group 2)
+    _NVME_DEV_RE = re.compile(r'^(nvme\d+n\d+)(p\d+)?$')
+    _NVME_PART_PATH_RE = re.compile(r'^/dev/nvme\d+n\d+p\d+$')
+    
+    # One KEY="value" field of `lsblk -P` output; quotes inside values are \x22-escaped.
+    # Matched on bytes so escaped UTF-8 sequences can be reassembled before decoding.
+    _LSBLK_PAIR_RE = re.compile(rb'([A-Z:-]+)="([^"]*)"')
+    _LSBLK_ESCAPE_RE = re.compile(rb'\\x([0-9a-fA-F]{2})')
+    
     def __init__(self):
         self.nvme_devices = []
         self.nvme_partitions = []
+        self._by_path = {}
+        self._cache_ts = None
+        self._cache_ttl = 2.0  # seconds a detection result stays valid
+    
+    def invalidate(self):
+        """Drop cached detection results so the next lookup rescans"""
+        self._cache_ts = None
     
     def detect_nvme_devices(self):
         """Detect all NVMe devices and their partitions"""
+        if self._cache_ts is not None and time.monotonic() - self._cache_ts < self._cache_ttl:
+            return self.nvme_devices
+        
         self.nvme_devices = []
         self.nvme_partitions = []
+        self._by_path = {}
         
         try:
-            # Use lsblk to get NVMe device information
+            # Single lsblk call for the whole tree; partitions come back as children
             result = subprocess.run([
-                'lsblk', '-J', '-o', 'NAME,SIZE,TYPE,MOUNTPOINT,FSTYPE,LABEL,UUID',
-                '-d', '-e7'  # Exclude loop devices
-            ], capture_output=True, text=True, check=True)
+                'lsblk', '-J', '-b', '-o', 'NAME,SIZE,TYPE,FSTYPE,LABEL,UUID,PARTUUID,MOUNTPOINT'
+            ], capture_output=True, check=True)
             
-            data = json.loads(result.stdout)
+            # Both decoders accept the raw bytes, no need to decode to str first
+            data = _json_loads(result.stdout)
             
             for device in data.get('blockdevices', []):
                 device_name = device.get('name', '')
-                if device_name.startswith('nvme'):
-                    nvme_info = {
-                        'device': f"/dev/{device_name}",
-                        'name': device_name,
-                        'size': device.get('size', 'Unknown'),
-                        'partitions': []
-                    }
-                    
-                    # Get partitions for this NVMe device
-                    partitions = self._get_nvme_partitions(device_name)
-                    nvme_info['partitions'] = partitions
-                    self.nvme_partitions.extend(partitions)
-                    
-                    self.nvme_devices.append(nvme_info)
+                if not device_name.startswith('nvme'):
+                    continue
+                
+                nvme_info = self._lsblk_device_info(device_name, device)
+                
+                for partition in self._iter_lsblk_partitions(device):
+                    part_name = partition.get('name', '')
+                    match = self._NVME_DEV_RE.match(part_name)
+                    if match and match.group(2):
+                        part_info = self._lsblk_partition_info(part_name, partition, device_name)
+                        self._add_partition(nvme_info, part_info)
+                
+                self.nvme_devices.append(nvme_info)
                     
         except (subprocess.CalledProcessError, json.JSONDecodeError, FileNotFoundError) as e:
             print(f"Warning: Could not detect NVMe devices: {e}")
-            # Fallback method
-            self._detect_nvme_fallback()
+            # Older util-linux without JSON output: try key="value" pairs,
+            # then fall back to scanning /dev and sysfs
+            if not self._detect_nvme_pairs():
+                self._detect_nvme_fallback()
         
+        self._cache_ts = time.monotonic()
         return self.nvme_devices
     
-    def _get_nvme_partitions(self, device_name):
-        """Get partitions for a specific NVMe device"""
-        partitions = []
+    def _add_partition(self, nvme_info, part_info):
+        """Record a detected partition under its device and in the path index"""
+        nvme_info['partitions'].append(part_info)
+        self.nvme_partitions.append(part_info)
+        self._by_path[part_info['device']] = part_info
+    
+    def _lsblk_device_info(self, device_name, node):
+        """Build an NVMe device entry from an lsblk node"""
+        size_bytes = int(node.get('size') or 0)
+        return {
+            'device': f"/dev/{device_name}",
+            'name': device_name,
+            'size': self._format_size(size_bytes),
+            'size_bytes': size_bytes,
+            'partitions': []
+        }
+    
+    def _lsblk_partition_info(self, part_name, node, device_name):
+        """Build an NVMe partition entry from an lsblk node"""
+        part_size = int(node.get('size') or 0)
+        return {
+            'device': f"/dev/{part_name}",
+            'name': part_name,
+            'size': self._format_size(part_size),
+            'size_bytes': part_size,
+            'fstype': node.get('fstype', ''),
+            'label': node.get('label', ''),
+            'uuid': node.get('uuid', ''),
+            'partuuid': node.get('partuuid', ''),
+            'mountpoint': node.get('mountpoint', ''),
+            'parent_device': f"/dev/{device_name}",
+            'bootable': self._check_bootable(part_name, node)
+        }
+    
+    def _detect_nvme_pairs(self):
+        """Detect NVMe devices from `lsblk -P` output (util-linux without -J)
         
+        Returns True if lsblk produced usable output.
+        """
         try:
-            # Get detailed partition info for this device
             result = subprocess.run([
-                'lsblk', '-J', '-o', 'NAME,SIZE,TYPE,MOUNTPOINT,FSTYPE,LABEL,UUID,PARTUUID',
-                f"/dev/{device_name}"
-            ], capture_output=True, text=True, check=True)
-            
-            data = json.loads(result.stdout)
+                'lsblk', '-P', '-b', '-o', 'NAME,SIZE,TYPE,FSTYPE,LABEL,UUID,PARTUUID,MOUNTPOINT,PKNAME'
+            ], capture_output=True, check=True)
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Warning: Could not detect NVMe devices with lsblk -P: {e}")
+            return False
+        
+        # lsblk lists parents before their children
+        devices = {}
+        for line in result.stdout.splitlines():
+            node = {
+                key.decode('ascii').lower(): self._unescape_lsblk(value)
+                for key, value in self._LSBLK_PAIR_RE.findall(line)
+            }
+            name = node.get('name', '')
+            match = self._NVME_DEV_RE.match(name)
+            if not match:
+                continue
             
-            for device in data.get('blockdevices', []):
-                children = device.get('children', [])
-                for partition in children:
-                    part_name = partition.get('name', '')
-                    if part_name.startswith('nvme') and 'p' in part_name:
-                        part_info = {
-                            'device': f"/dev/{part_name}",
-                            'name': part_name,
-                            'size': partition.get('size', 'Unknown'),
-                            'fstype': partition.get('fstype', ''),
-                            'label': partition.get('label', ''),
-                            'uuid': partition.get('uuid', ''),
-                            'partuuid': partition.get('partuuid', ''),
-                            'mountpoint': partition.get('mountpoint', ''),
-                            'parent_device': f"/dev/{device_name}",
-                            'bootable': self._check_bootable(part_name, partition)
-                        }
-                        partitions.append(part_info)
-                        
-        except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
-            print(f"Warning: Could not get partitions for {device_name}: {e}")
+            if not match.group(2):
+                nvme_info = self._lsblk_device_info(name, node)
+                devices[name] = nvme_info
+                self.nvme_devices.append(nvme_info)
+            elif node.get('type') == 'part':
+                device_name = node.get('pkname') or match.group(1)
+                nvme_info = devices.get(device_name)
+                if nvme_info is not None:
+                    part_info = self._lsblk_partition_info(name, node, device_name)
+                    self._add_partition(nvme_info, part_info)
         
-        return partitions
+        return True
+    
+    def _unescape_lsblk(self, value):
+        """Decode an `lsblk -P` value, turning \\xNN escapes back into UTF-8 bytes"""
+        raw = self._LSBLK_ESCAPE_RE.sub(lambda m: bytes((int(m.group(1), 16),)), value)
+        return raw.decode('utf-8', 'replace')
+    
+    def _iter_lsblk_partitions(self, node):
+        """Yield every partition node below an lsblk tree node"""
+        for child in node.get('children', []):
+            if child.get('type') == 'part':
+                yield child
+            yield from self._iter_lsblk_partitions(child)
+    
+    def _nvme_sort_key(self, name):
+        """Sort key ordering nvmeXnY[pZ] names numerically (p2 before p10)"""
+        return tuple(int(number) for number in re.findall(r'\d+', name))
     
     def _detect_nvme_fallback(self):
         """Fallback NVMe detection method"""
         try:
-            # Look for NVMe devices in /dev/
-            for device_path in Path('/dev').glob('nvme*n*'):
-                if device_path.is_block_device():
-                    device_name = device_path.name
-                    nvme_info = {
-                        'device': str(device_path),
-                        'name': device_name,
-                        'size': self._get_device_size(str(device_path)),
-                        'partitions': []
-                    }
+            # Single pass over /dev, bucketing partitions by their namespace
+            namespaces = []
+            children = {}
+            with os.scandir('/dev') as entries:
+                for entry in entries:
+                    match = self._NVME_DEV_RE.match(entry.name)
+                    if not match:
+                        continue
+                    try:
+                        if not stat.S_ISBLK(entry.stat().st_mode):
+                            continue
+                    except OSError:
+                        continue
                     
-                    # Find partitions
-                    for part_path in Path('/dev').glob(f'{device_name}p*'):
-                        if part_path.is_block_device():
-                            part_info = {
-                                'device': str(part_path),
-                                'name': part_path.name,
-                                'size': self._get_device_size(str(part_path)),
-                                'fstype': '',
-                                'label': '',
-                                'uuid': '',
-                                'partuuid': '',
-                                'mountpoint': '',
-                                'parent_device': str(device_path),
-                                'bootable': self._check_bootable_fallback(str(part_path))
-                            }
-                            nvme_info['partitions'].append(part_info)
-                            self.nvme_partitions.append(part_info)
-                    
-                    self.nvme_devices.append(nvme_info)
+                    if match.group(2):
+                        children.setdefault(match.group(1), []).append(entry.name)
+                    else:
+                        namespaces.append(entry.name)
+            
+            for device_name in sorted(namespaces, key=self._nvme_sort_key):
+                device_path = f"/dev/{device_name}"
+                size_bytes = self._get_device_size(device_path)
+                nvme_info = {
+                    'device': device_path,
+                    'name': device_name,
+                    'size': self._format_size(size_bytes) if size_bytes else "Unknown",
+                    'size_bytes': size_bytes,
+                    'partitions': []
+                }
+                
+                # Find partitions
+                for part_name in sorted(children.get(device_name, []), key=self._nvme_sort_key):
+                    part_path = f"/dev/{part_name}"
+                    part_size = self._get_device_size(part_path)
+                    part_info = {
+                        'device': part_path,
+                        'name': part_name,
+                        'size': self._format_size(part_size) if part_size else "Unknown",
+                        'size_bytes': part_size,
+                        'fstype': '',
+                        'label': '',
+                        'uuid': '',
+                        'partuuid': '',
+                        'mountpoint': '',
+                        'parent_device': device_path,
+                        'bootable': False
+                    }
+                    self._add_partition(nvme_info, part_info)
+                
+                self.nvme_devices.append(nvme_info)
+            
+            # Probe boot signatures concurrently; each read targets a separate partition
+            if self.nvme_partitions:
+                paths = [p['device'] for p in self.nvme_partitions]
+                with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+                    results = executor.map(self._check_bootable_fallback, paths)
+                    for part_info, bootable in zip(self.nvme_partitions, results):
+                        part_info['bootable'] = bootable
                     
         except Exception as e:
             print(f"Warning: Fallback NVMe detection failed: {e}")
     
     def _get_device_size(self, device_path):
-        """Get device size using blockdev"""
+        """Get device size in bytes from sysfs (0 if unknown)"""
+        name = os.path.basename(device_path)
         try:
-            result = subprocess.run([
-                'blockdev', '--getsize64', device_path
-            ], capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                size_bytes = int(result.stdout.strip())
-                return self._format_size(size_bytes)
-        except:
+            # sysfs reports the size in 512-byte sectors
+            with open(f'/sys/class/block/{name}/size') as f:
+                return int(f.read()) << 9
+        except (OSError, ValueError):
             pass
         
-        return "Unknown"
+        return 0
     
     def _format_size(self, size_bytes):
         """Format size in human readable format"""
@@ -157,72 +271,55 @@ class NVMeHandler:
         fstype = (partition_info.get('fstype') or '').lower()
         label = (partition_info.get('label') or '').lower()
         
-        # Common bootable filesystem types
-        bootable_fs = ['fat32', 'vfat', 'fat16', 'ntfs', 'ext2', 'ext3', 'ext4', 'btrfs', 'xfs']
-        
         # Check filesystem type
-        if fstype in bootable_fs:
+        if fstype in self._BOOTABLE_FS:
             return True
         
         # Check for common boot partition labels
-        boot_labels = ['boot', 'efi', 'system', 'recovery', 'windows', 'linux']
-        if any(boot_label in label for boot_label in boot_labels):
+        if self._BOOT_LABEL_RE.search(label):
             return True
         
         # Check if it's an EFI system partition (typically around 100-512MB)
-        size_str = partition_info.get('size', '')
-        if 'M' in size_str:
-            try:
-                size_mb = float(size_str.replace('M', ''))
-                if 50 <= size_mb <= 1024 and fstype in ['fat32', 'vfat']:
-                    return True
-            except:
-                pass
+        size_bytes = int(partition_info.get('size') or 0)
+        if 50 * 1024 * 1024 <= size_bytes <= 1024 * 1024 * 1024 and fstype in self._EFI_FS:
+            return True
         
         return False
     
     def _check_bootable_fallback(self, device_path):
         """Fallback method to check if partition is bootable"""
         try:
-            # Try to read the first sector
-            with open(device_path, 'rb') as f:
-                first_sector = f.read(512)
-                # Check for boot signature (0x55AA at the end)
-                if len(first_sector) >= 512 and first_sector[510:512] == b'\x55\xAA':
-                    return True
-        except:
+            # Only read the boot signature (0x55AA at offset 510 of the first sector)
+            fd = os.open(device_path, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                return os.pread(fd, 2, 510) == b'\x55\xAA'
+            finally:
+                os.close(fd)
+        except OSError:
             pass
         
         return False
     
     def get_bootable_partitions(self):
         """Get list of potentially bootable NVMe partitions"""
-        if not self.nvme_partitions:
-            self.detect_nvme_devices()
+        self.detect_nvme_devices()
         
         return [p for p in self.nvme_partitions if p.get('bootable', False)]
     
     def get_all_partitions(self):
         """Get all NVMe partitions"""
-        if not self.nvme_partitions:
-            self.detect_nvme_devices()
+        self.detect_nvme_devices()
         
         return self.nvme_partitions
     
     def is_nvme_partition(self, device_path):
         """Check if a device path is an NVMe partition"""
-        return device_path.startswith('/dev/nvme') and 'p' in device_path
+        return bool(self._NVME_PART_PATH_RE.match(device_path))
     
     def get_partition_info(self, device_path):
         """Get detailed information about a specific partition"""
-        if not self.nvme_partitions:
-            self.detect_nvme_devices()
-        
-        for partition in self.nvme_partitions:
-            if partition['device'] == device_path:
-                return partition
-        
-        return None
+        self.detect_nvme_devices()
+        return self._by_path.get(device_path)
     
     def validate_nvme_partition(self, device_path):
         """Validate an NVMe partition for booting"""
@@ -234,7 +331,6 @@ class NVMeHandler:
         
         try:
             # Check if it's a block device
-            import stat
             st = os.stat(device_path)
             if not stat.S_ISBLK(st.st_mode):
                 return False, "Not a valid block device"
@@ -245,8 +341,7 @@ class NVMeHandler:
                 return False, "Could not get partition information"
             
             # Check if partition has some size
-            size_str = partition_info.get('size', '')
-            if size_str == 'Unknown' or size_str == '0B':
+            if not partition_info.get('size_bytes'):
                 return False, "Partition appears to be empty"
             
             # Check if it's mounted (warn but don't prevent)
@@ -271,5 +366,6 @@ class NVMeHandler:
                     print(f"Warning: Could not unmount {device_path}: {result.stderr}")
                 else:
                     print(f"Successfully unmounted {device_path}")
+                    self.invalidate()
         except Exception as e:
             print(f"Warning: Error during unmount of {device_path}: {e}")
\ No newline at end of file
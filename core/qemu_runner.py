@@ -3,14 +3,81 @@ QEMU runner for MobaLiveCD Linux
 Handles QEMU execution and configuration
 """
 
+import collections
+import functools
 import os
 import stat
 import subprocess
 import shutil
+import sys
 import tempfile
+import threading
 from pathlib import Path
 from .nvme_handler import NVMeHandler
 
+# Static argument groups spliced into every QEMU command line
+_QEMU_KVM_CPU = ('-cpu', 'host')
+_QEMU_TCG_CPU = ('-cpu', 'max')
+_QEMU_AUDIO = ('-audiodev', 'alsa,id=audio0', '-device', 'AC97,audiodev=audio0')
+_QEMU_USB = ('-usb', '-device', 'usb-tablet')  # usb-tablet for better mouse integration
+_QEMU_NETWORK = ('-netdev', 'user,id=net0', '-device', 'rtl8139,netdev=net0')
+_QEMU_USB_RTC = ('-rtc', 'base=utc')
+
+
+@functools.lru_cache(maxsize=1)
+def find_qemu_binary():
+    """Find the appropriate QEMU binary (cached for the process lifetime)"""
+    candidates = [
+        'qemu-system-x86_64',
+        'qemu-system-i386',
+        'qemu'
+    ]
+    
+    for binary in candidates:
+        if shutil.which(binary):
+            return binary
+            
+    raise RuntimeError("QEMU not found. Please install qemu-system-x86 package")
+
+
+@functools.lru_cache(maxsize=1)
+def check_kvm_support():
+    """Check if KVM acceleration is available (cached for the process lifetime)"""
+    # os.access is False for a missing /dev/kvm, so no separate existence check
+    return os.access('/dev/kvm', os.R_OK | os.W_OK)
+
+
+@functools.lru_cache(maxsize=None)
+def _qemu_version(binary):
+    """QEMU version string for binary (cached for the process lifetime)"""
+    try:
+        result = subprocess.run(
+            [binary, '--version'],
+            capture_output=True,
+            text=True,
+            timeout=5
+        )
+        if result.returncode == 0:
+            return result.stdout.strip().split('\n')[0]
+    except:
+        pass
+    
+    return 'Unknown'
+
+
+# Number of trailing stderr lines kept for error reporting
+_STDERR_TAIL_LINES = 50
+
+
+def _drain_stderr(stream, tail, echo):
+    """Consume QEMU's stderr so a long-running guest never blocks on a full pipe"""
+    with stream:
+        for line in stream:
+            tail.append(line)
+            if echo:
+                sys.stderr.write(line.decode('utf-8', errors='replace'))
+
+
 class QEMURunner:
     """Handles QEMU execution for ISO files"""
     
@@ -23,25 +90,11 @@ class QEMURunner:
         
     def find_qemu_binary(self):
         """Find the appropriate QEMU binary"""
-        candidates = [
-            'qemu-system-x86_64',
-            'qemu-system-i386',
-            'qemu'
-        ]
-        
-        for binary in candidates:
-            if shutil.which(binary):
-                return binary
-                
-        raise RuntimeError("QEMU not found. Please install qemu-system-x86 package")
+        return find_qemu_binary()
     
     def check_kvm_support(self):
         """Check if KVM acceleration is available"""
-        try:
-            # Check if /dev/kvm exists and is accessible
-            return os.path.exists('/dev/kvm') and os.access('/dev/kvm', os.R_OK | os.W_OK)
-        except:
-            return False
+        return check_kvm_support()
     
     def build_qemu_command(self, boot_source, **options):
         """Build QEMU command line arguments
@@ -51,120 +104,84 @@ class QEMURunner:
             **options: Additional QEMU options
         """
         
-        # Base command
-        cmd = [self.qemu_binary]
+        # Classify the boot source once; _is_usb_device stats the path
+        is_usb = self._is_usb_device(boot_source)
+        is_nvme = not is_usb and self._is_nvme_partition(boot_source)
         
-        # Memory allocation based on boot source type
-        if self._is_usb_device(boot_source):
+        if is_usb:
             memory = options.get('memory', '4096M')  # 4GB for USB devices
-        elif self._is_nvme_partition(boot_source):
-            memory = options.get('memory', '8192M')  # 8GB for NVMe partitions (balance between performance and safety)
-        else:
-            memory = options.get('memory', self.default_memory)  # 16GB for ISOs
-        cmd.extend(['-m', memory])
-        
-        # Machine type selection based on boot source
-        if self._is_usb_device(boot_source):
             # Use older, more compatible machine type for Ventoy
             machine_type = 'pc-q35-2.12'
-        elif self._is_nvme_partition(boot_source):
-            # Use Q35 chipset for NVMe partitions (better NVMe support)
-            machine_type = 'pc-q35-7.2'
-        else:
-            # Use modern machine type for ISOs
-            machine_type = 'pc-i440fx-7.2'
-            
-        if self.use_kvm and options.get('enable_kvm', True):
-            cmd.extend(['-machine', f'{machine_type},accel=kvm'])
-        else:
-            cmd.extend(['-machine', f'{machine_type},accel=tcg'])
-        
-        # CPU - use host CPU if KVM is available
-        if self.use_kvm:
-            cmd.extend(['-cpu', 'host'])
-        
-        # Display
-        display = options.get('display', 'gtk')
-        if display == 'none':
-            cmd.extend(['-display', 'none'])
-        else:
-            # Use GTK display (remove GL to avoid potential issues)
-            cmd.extend(['-display', 'gtk'])
-        
-        # VGA adapter selection based on boot source
-        if self._is_usb_device(boot_source):
             # Use standard VGA for USB devices (better Ventoy compatibility)
             vga = options.get('vga', 'std')
-        elif self._is_nvme_partition(boot_source):
+            # Comprehensive boot configuration with 10s timeout
+            boot = 'order=c,menu=on,strict=off,splash-time=10000'
+            # Add USB device as primary hard drive for better compatibility with Ventoy
+            drive = ('-hda', boot_source)
+        elif is_nvme:
+            memory = options.get('memory', '8192M')  # 8GB for NVMe partitions (balance between performance and safety)
+            # Use Q35 chipset for NVMe partitions (better NVMe support)
+            machine_type = 'pc-q35-7.2'
             # Use virtio for NVMe partitions (good performance with OS compatibility)
             vga = options.get('vga', 'virtio')
+            # Boot from hard disk with menu, 5s timeout
+            boot = 'order=c,menu=on,strict=off,splash-time=5000'
+            # Add NVMe partition as primary hard drive with optimized settings
+            drive = ('-drive', f'file={boot_source},format=raw,cache=none,if=virtio')
         else:
+            memory = options.get('memory', self.default_memory)  # 16GB for ISOs
+            # Use modern machine type for ISOs
+            machine_type = 'pc-i440fx-7.2'
             # Use virtio for ISO files (better performance)
             vga = options.get('vga', 'virtio')
-        cmd.extend(['-vga', vga])
-        
-        # Boot configuration based on source type
-        if self._is_usb_device(boot_source):
-            # For USB devices - comprehensive boot configuration with timeout
-            cmd.extend(['-boot', 'order=c,menu=on,strict=off,splash-time=10000'])  # 10s timeout
-        elif self._is_nvme_partition(boot_source):
-            # For NVMe partitions - boot from hard disk with menu
-            cmd.extend(['-boot', 'order=c,menu=on,strict=off,splash-time=5000'])  # 5s timeout
-        else:
             # For ISO files, boot from CD-ROM
-            cmd.extend(['-boot', 'order=d,menu=on'])  # d = CD-ROM
-        
-        # Configure storage device based on boot source type
-        if self._is_usb_device(boot_source):
-            # Add USB device as primary hard drive for better compatibility with Ventoy
-            cmd.extend(['-hda', boot_source])
-        elif self._is_nvme_partition(boot_source):
-            # Add NVMe partition as primary hard drive with optimized settings
-            cmd.extend(['-drive', f'file={boot_source},format=raw,cache=none,if=virtio'])
-            
-            # Add UEFI support for NVMe partitions (especially ZFS)
-            self._add_uefi_support(cmd, boot_source)
-        else:
+            boot = 'order=d,menu=on'
             # Add ISO as CD-ROM with better caching
-            cmd.extend(['-drive', f'file={boot_source},media=cdrom,readonly=on,cache=unsafe'])
-        
-        # Audio (simplified to avoid PulseAudio issues)
-        if options.get('enable_audio', False):  # Disabled by default
-            cmd.extend(['-audiodev', 'alsa,id=audio0'])
-            cmd.extend(['-device', 'AC97,audiodev=audio0'])
-        
-        # USB
-        cmd.extend(['-usb'])
-        cmd.extend(['-device', 'usb-tablet'])  # Better mouse integration
-        
-        # Network (user mode)
-        if options.get('enable_network', True):
-            cmd.extend(['-netdev', 'user,id=net0'])
-            cmd.extend(['-device', 'rtl8139,netdev=net0'])
+            drive = ('-drive', f'file={boot_source},media=cdrom,readonly=on,cache=unsafe')
         
-        # Additional options for better compatibility
-        cmd.extend(['-no-reboot'])
+        accel = 'kvm' if self.use_kvm and options.get('enable_kvm', True) else 'tcg'
+        # Use GTK display (remove GL to avoid potential issues)
+        display = 'none' if options.get('display', 'gtk') == 'none' else 'gtk'
         
-        # Add RTC for USB devices for better time handling
-        if self._is_usb_device(boot_source):
-            cmd.extend(['-rtc', 'base=utc'])
-        
-        # For USB devices (like Ventoy), add specific compatibility options
-        if self._is_usb_device(boot_source):
-            # Use standard VGA for better Ventoy compatibility
-            # Ventoy sometimes has issues with virtio-vga
-            pass
+        cmd = [
+            self.qemu_binary,
+            '-m', memory,
+            '-machine', f'{machine_type},accel={accel}',
+            # CPU - use host CPU if KVM is available
+            *(_QEMU_KVM_CPU if self.use_kvm else ()),
+            '-display', display,
+            '-vga', vga,
+            '-boot', boot,
+            *drive,
+        ]
         
-        # Enable more CPU features for better compatibility
-        if not self.use_kvm:
-            cmd.extend(['-cpu', 'max'])
+        if is_nvme:
+            # Add UEFI support for NVMe partitions (especially ZFS)
+            self._add_uefi_support(cmd, boot_source)
         
-        # Machine type already set above with acceleration
+        cmd += [
+            # Audio (simplified to avoid PulseAudio issues, disabled by default)
+            *(_QEMU_AUDIO if options.get('enable_audio', False) else ()),
+            *_QEMU_USB,
+            # Network (user mode)
+            *(_QEMU_NETWORK if options.get('enable_network', True) else ()),
+            # Additional options for better compatibility
+            '-no-reboot',
+            # Add RTC for USB devices for better time handling
+            *(_QEMU_USB_RTC if is_usb else ()),
+            # Enable more CPU features for better compatibility
+            *(_QEMU_TCG_CPU if not self.use_kvm else ()),
+        ]
         
         return cmd
     
-    def _is_usb_device(self, path):
-        """Check if path is a USB device (e.g., /dev/sdb)"""
+    def _is_usb_device(self, path, st=None):
+        """Check if path is a USB device (e.g., /dev/sdb)
+        
+        Args:
+            path: Device path to check
+            st: Optional os.stat result for path, to avoid stat-ing it again
+        """
         if not path.startswith('/dev/') or path.lower().endswith('.iso'):
             return False
         
@@ -174,8 +191,9 @@ class QEMURunner:
         
         # Check if it's a block device
         try:
-            mode = os.stat(path).st_mode
-            return stat.S_ISBLK(mode)
+            if st is None:
+                st = os.stat(path)
+            return stat.S_ISBLK(st.st_mode)
         except (OSError, FileNotFoundError):
             return False
     
@@ -251,24 +269,36 @@ class QEMURunner:
         
         try:
             # Run QEMU - don't wait for it to complete
+            quiet = options.get('quiet', True)
             process = subprocess.Popen(
                 cmd,
-                stdout=subprocess.PIPE if options.get('quiet', True) else None,
+                stdout=subprocess.DEVNULL if quiet else None,
                 stderr=subprocess.PIPE
             )
             
+            # Keep stderr drained for the lifetime of QEMU, remembering the
+            # last lines in case it exits straight away
+            stderr_tail = collections.deque(maxlen=_STDERR_TAIL_LINES)
+            drainer = threading.Thread(
+                target=_drain_stderr,
+                args=(process.stderr, stderr_tail, not quiet),
+                daemon=True
+            )
+            drainer.start()
+            
             # Just check if it started successfully
             # Don't wait for completion as QEMU should run independently
-            import time
-            time.sleep(1)  # Give QEMU a moment to start
-            
-            if process.poll() is not None:
+            try:
+                process.wait(timeout=0.1)
+            except subprocess.TimeoutExpired:
+                # Still running after startup - QEMU launched fine
+                print(f"QEMU started successfully with PID: {process.pid}")
+            else:
                 # Process has already terminated - there was an error
-                stdout, stderr = process.communicate()
+                drainer.join(timeout=1)
+                stderr = b''.join(stderr_tail)
                 error_msg = stderr.decode('utf-8') if stderr else "QEMU failed to start"
                 raise RuntimeError(f"QEMU failed: {error_msg}")
-            
-            print(f"QEMU started successfully with PID: {process.pid}")
                 
         except FileNotFoundError:
             raise RuntimeError(f"QEMU binary '{self.qemu_binary}' not found")
@@ -282,71 +312,49 @@ class QEMURunner:
     
     def get_system_info(self):
         """Get system information for diagnostics"""
-        info = {
+        return {
             'qemu_binary': self.qemu_binary,
             'kvm_available': self.use_kvm,
-            'memory': self.default_memory
+            'memory': self.default_memory,
+            'qemu_version': _qemu_version(self.qemu_binary)
         }
-        
-        # Get QEMU version
-        try:
-            result = subprocess.run(
-                [self.qemu_binary, '--version'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0:
-                info['qemu_version'] = result.stdout.strip().split('\n')[0]
-        except:
-            info['qemu_version'] = 'Unknown'
-        
-        return info
     
     def validate_boot_source(self, boot_source):
         """Basic validation of boot source (ISO file, USB device, or NVMe partition)"""
-        if not os.path.exists(boot_source):
+        # Stat once and reuse the result for the type and size checks below
+        try:
+            st = os.stat(boot_source)
+        except OSError:
             return False, "Boot source does not exist"
         
         if self._is_nvme_partition(boot_source):
             # Validate NVMe partition using specialized handler
             return self.nvme_handler.validate_nvme_partition(boot_source)
-        elif self._is_usb_device(boot_source):
-            # Validate USB device
-            try:
-                # Check if it's a block device
-                import stat
-                st = os.stat(boot_source)
-                if not stat.S_ISBLK(st.st_mode):
-                    return False, "Not a valid block device"
-                
-                # Check if device has some size
-                size = st.st_size
-                if size == 0:
-                    # For block devices, size might be 0, try to read device size differently
-                    try:
-                        with open(boot_source, 'rb') as f:
-                            f.seek(0, 2)  # Seek to end
-                            size = f.tell()
-                    except (OSError, IOError):
-                        pass  # Size check not critical for USB devices
-                        
-                return True, "Valid USB device"
-                
-            except OSError as e:
-                return False, f"Cannot access device: {e}"
+        elif self._is_usb_device(boot_source, st):
+            # Validate USB device (_is_usb_device already checked it is a block device)
+            # Check if device has some size
+            size = st.st_size
+            if size == 0:
+                # For block devices, size might be 0, try to read device size differently
+                try:
+                    with open(boot_source, 'rb') as f:
+                        f.seek(0, 2)  # Seek to end
+                        size = f.tell()
+                except (OSError, IOError):
+                    pass  # Size check not critical for USB devices
+                    
+            return True, "Valid USB device"
         else:
             # Validate ISO file
             if not boot_source.lower().endswith('.iso'):
                 return False, "File does not have .iso extension"
             
+            if not stat.S_ISREG(st.st_mode):
+                return False, "Not a regular file"
+            
             # Check file size (should be > 1MB for a valid ISO)
-            try:
-                size = os.path.getsize(boot_source)
-                if size < 1024 * 1024:  # 1MB
-                    return False, "File too small to be a valid ISO"
-            except OSError as e:
-                return False, f"Cannot read file: {e}"
+            if st.st_size < 1024 * 1024:  # 1MB
+                return False, "File too small to be a valid ISO"
             
             return True, "Valid ISO file"
     
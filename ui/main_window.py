@@ -318,14 +318,14 @@ class MobaLiveCDWindow(Adw.ApplicationWindow):
         dialog = NVMePartitionSelectorDialog(self)
         dialog.present()
         
-        def on_dialog_response(dialog, response_id):
+        def on_dialog_response(response_id):
             if response_id == 'select':
                 partition_path = dialog.get_selected_partition()
                 if partition_path:
                     self.load_boot_source(partition_path, 'nvme')
             dialog.destroy()
         
-        dialog.connect('response', on_dialog_response)
+        dialog.on_response = on_dialog_response
     
     def on_run_boot_source(self, button):
         """Handle running the boot source (ISO or USB)"""
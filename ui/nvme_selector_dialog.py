@@ -2,20 +2,65 @@
 NVMe partition selector dialog for MobaLiveCD Linux
 """
 
+import os
+import threading
+import time
+
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
 
-from gi.repository import Gtk, Adw, GObject
+from gi.repository import Gtk, Adw, GObject, Gio, GLib
 from core.nvme_handler import NVMeHandler
 
 
+_WARNING_TEXT = (
+    "You are about to boot directly from an NVMe partition. This will:\n\n"
+    "• Grant QEMU direct access to your partition data\n"
+    "• Potentially modify the partition if the OS writes to it\n"
+    "• Risk data corruption if not handled carefully\n\n"
+    "Make sure you have backups of important data before proceeding!"
+)
+
+_INFO_TEXT = "\n".join((
+    "• Green partitions (✓) are detected as potentially bootable",
+    "• Yellow partitions are currently mounted - they will be unmounted before booting",
+    "• You can select any partition, but bootable ones are more likely to work",
+))
+
+# Partition fields shown in a row subtitle, in display order
+_SUB_FIELDS = (
+    ('fstype', 'FS: {}'),
+    ('label', 'Label: {}'),
+    ('mountpoint', 'Mounted: {}'),
+)
+
+
+class PartitionItem(GObject.Object):
+    """List model item for one row of the partition list
+    
+    Rows are either device headers, selectable partitions, or plain
+    informational messages (no devices, errors, tips).
+    """
+    
+    __gtype_name__ = 'MobaLiveCDPartitionItem'
+    
+    def __init__(self, title, subtitle='', partition=None, css_class=None):
+        super().__init__()
+        self.title = title
+        self.subtitle = subtitle
+        self.partition = partition
+        self.css_class = css_class
+        # Everything the row displays; equal keys render identical rows
+        self.key = (title, subtitle, css_class, partition['device'] if partition else None)
+
+
 class NVMePartitionSelectorDialog(Adw.Window):
     """Dialog for selecting NVMe partitions to boot"""
     
-    __gsignals__ = {
-        'response': (GObject.SignalFlags.RUN_FIRST, None, (str,))
-    }
+    # (timestamp, fingerprint, nvme_devices) shared by all dialog instances
+    _device_cache = None
+    _device_cache_ttl = 5.0
     
     def __init__(self, parent_window):
         super().__init__()
@@ -23,12 +68,28 @@ class NVMePartitionSelectorDialog(Adw.Window):
         self.parent_window = parent_window
         self.nvme_handler = NVMeHandler()
         self.selected_partition = None
+        self.on_response = None  # called with 'select' or 'cancel'
+        self._closed = False
+        self._partition_group = None  # first radio button, leader of the group
+        self._scan_inflight = False
+        self._last_fingerprint = None
+        self._last_scan = None
+        self._last_scan_ts = None  # time.monotonic() of the hardware scan behind _last_scan
+        self._last_snapshot = ()  # keys of the items currently in the store
         
         # Window properties
         self.set_title("Select NVMe Partition")
         self.set_default_size(600, 500)
         self.set_transient_for(parent_window)
         self.set_modal(True)
+        self.connect('close-request', self.on_close_request)
+        
+        # Resolve the bootable marker icon once; every row shares the paintable
+        icon_theme = Gtk.IconTheme.get_for_display(self.get_display())
+        self._boot_icon_paintable = icon_theme.lookup_icon(
+            "emblem-ok-symbolic", None, 16, 1,
+            Gtk.TextDirection.NONE, Gtk.IconLookupFlags(0)
+        )
         
         # Setup UI
         self.setup_ui()
@@ -68,13 +129,7 @@ class NVMePartitionSelectorDialog(Adw.Window):
         # Warning section
         warning_group = Adw.PreferencesGroup()
         warning_group.set_title("⚠️ Important Warning")
-        warning_group.set_description(
-            "You are about to boot directly from an NVMe partition. This will:\n\n"
-            "• Grant QEMU direct access to your partition data\n"
-            "• Potentially modify the partition if the OS writes to it\n"
-            "• Risk data corruption if not handled carefully\n\n"
-            "Make sure you have backups of important data before proceeding!"
-        )
+        warning_group.set_description(_WARNING_TEXT)
         
         warning_row = Adw.ActionRow()
         warning_row.set_title("Read and understand the risks above")
@@ -86,6 +141,29 @@ class NVMePartitionSelectorDialog(Adw.Window):
         # Partitions section
         self.partitions_group = Adw.PreferencesGroup()
         self.partitions_group.set_title("Available NVMe Partitions")
+        
+        # Rows are recycled by the list view, so only visible rows get widgets
+        self.partition_store = Gio.ListStore.new(PartitionItem)
+        self.partition_selection = Gtk.SingleSelection.new(self.partition_store)
+        self.partition_selection.set_autoselect(False)
+        self.partition_selection.set_can_unselect(True)
+        self.partition_selection.connect('selection-changed', self.on_partition_selected)
+        
+        factory = Gtk.SignalListItemFactory()
+        factory.connect('setup', self.on_factory_setup)
+        factory.connect('bind', self.on_factory_bind)
+        
+        partition_list = Gtk.ListView.new(self.partition_selection, factory)
+        
+        partitions_scrolled = Gtk.ScrolledWindow()
+        partitions_scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        partitions_scrolled.set_min_content_height(250)
+        partitions_scrolled.set_max_content_height(400)
+        partitions_scrolled.set_propagate_natural_height(True)
+        partitions_scrolled.add_css_class("card")
+        partitions_scrolled.set_child(partition_list)
+        self.partitions_group.add(partitions_scrolled)
+        
         content.add(self.partitions_group)
         
         # Refresh button section
@@ -106,186 +184,272 @@ class NVMePartitionSelectorDialog(Adw.Window):
         scrolled.set_child(content)
         main_box.append(scrolled)
     
+    def on_factory_setup(self, factory, list_item):
+        """Create the widgets for a recycled partition list row"""
+        row = Adw.ActionRow()
+        
+        # Bootable indicator
+        bootable_icon = Gtk.Image.new_from_paintable(self._boot_icon_paintable)
+        bootable_icon.set_tooltip_text("Potentially bootable")
+        row.add_prefix(bootable_icon)
+        
+        # Radio button mirrors the list selection
+        radio_button = Gtk.CheckButton()
+        radio_button.set_group(self._partition_group)
+        if self._partition_group is None:
+            self._partition_group = radio_button
+        radio_button.set_can_target(False)
+        row.add_suffix(radio_button)
+        
+        row.bootable_icon = bootable_icon
+        row.radio_button = radio_button
+        row.css_class = None
+        list_item.set_child(row)
+        list_item.connect('notify::selected', self.on_list_item_selected)
+    
+    def on_list_item_selected(self, list_item, pspec):
+        """Keep a row's radio button in sync with the list selection"""
+        list_item.get_child().radio_button.set_active(list_item.get_selected())
+    
+    def on_factory_bind(self, factory, list_item):
+        """Show a PartitionItem in a recycled row"""
+        row = list_item.get_child()
+        item = list_item.get_item()
+        partition = item.partition
+        
+        # Batch property notifications for all updates to this row
+        with row.freeze_notify():
+            row.set_title(item.title)
+            row.set_subtitle(item.subtitle)
+            
+            # Only touch style classes when they change; each change restyles the row
+            if row.css_class != item.css_class:
+                if row.css_class:
+                    row.remove_css_class(row.css_class)
+                if item.css_class:
+                    row.add_css_class(item.css_class)
+                row.css_class = item.css_class
+            
+            row.bootable_icon.set_visible(bool(partition and partition.get('bootable', False)))
+            row.radio_button.set_visible(partition is not None)
+            row.radio_button.set_active(list_item.get_selected())
+        
+        # Only partitions can be selected
+        list_item.set_selectable(partition is not None)
+        list_item.set_activatable(partition is not None)
+    
     def refresh_partitions(self):
         """Refresh the list of available NVMe partitions"""
-        # Clear existing partition rows by creating a new preferences group
-        # This avoids the GTK widget removal issues
+        self.show_partitions(self._scan())
+    
+    def _scan(self):
+        """Detect NVMe devices, returning the device list or the raised exception"""
         try:
-            # Get parent container
-            parent = self.partitions_group.get_parent()
-            if parent:
-                # Remove old group
-                parent.remove(self.partitions_group)
-                
-                # Create new group
-                self.partitions_group = Adw.PreferencesGroup()
-                self.partitions_group.set_title("Available NVMe Partitions")
-                
-                # Add back to parent (after refresh_group and before content end)
-                # Find the refresh group to insert before it
-                refresh_child = None
-                child = parent.get_first_child()
-                while child is not None:
-                    if hasattr(child, 'get_title') and child.get_title() and "refresh" in child.get_title().lower():
-                        refresh_child = child
-                        break
-                    child = child.get_next_sibling()
-                
-                if refresh_child:
-                    parent.insert_child_before(self.partitions_group, refresh_child)
-                else:
-                    parent.append(self.partitions_group)
-            else:
-                # Fallback: try to clear children individually but more safely
-                while True:
-                    child = self.partitions_group.get_first_child()
-                    if child is None:
-                        break
-                    try:
-                        self.partitions_group.remove(child)
-                    except:
-                        break  # Exit if removal fails
+            return self.detect_devices()
         except Exception as e:
-            print(f"Warning: Error during partition refresh: {e}")
-        
-        # Reset selection
-        self.selected_partition = None
-        self.select_button.set_sensitive(False)
+            return e
+    
+    def show_partitions(self, scan_result):
+        """Populate the partition list from a _scan() result"""
+        items = []
         
-        # Detect NVMe devices and partitions
         try:
-            nvme_devices = self.nvme_handler.detect_nvme_devices()
+            if isinstance(scan_result, Exception):
+                raise scan_result
+            nvme_devices = scan_result
             
             if not nvme_devices:
                 # No NVMe devices found
-                no_devices_row = Adw.ActionRow()
-                no_devices_row.set_title("No NVMe devices found")
-                no_devices_row.set_subtitle("Make sure you have NVMe storage devices installed")
-                no_devices_row.add_css_class("dim-label")
-                self.partitions_group.add(no_devices_row)
-                return
-            
-            # Group partitions by device
-            for device in nvme_devices:
-                # Add device header
-                device_row = Adw.ActionRow()
-                device_row.set_title(f"🔧 {device['name']} ({device['size']})")
-                device_row.set_subtitle(f"Device: {device['device']}")
-                device_row.add_css_class("accent")
-                self.partitions_group.add(device_row)
-                
-                partitions = device.get('partitions', [])
-                if not partitions:
-                    # No partitions on this device
-                    no_parts_row = Adw.ActionRow()
-                    no_parts_row.set_title("  └─ No partitions found")
-                    no_parts_row.add_css_class("dim-label")
-                    self.partitions_group.add(no_parts_row)
-                    continue
-                
-                # Add partitions
-                for i, partition in enumerate(partitions):
-                    is_last = i == len(partitions) - 1
-                    prefix = "  └─ " if is_last else "  ├─ "
-                    
-                    # Create partition row
-                    part_row = Adw.ActionRow()
-                    
-                    # Title with partition info
-                    title = f"{prefix}{partition['name']} ({partition['size']})"
-                    part_row.set_title(title)
-                    
-                    # Subtitle with filesystem and mount info
-                    subtitle_parts = []
-                    if partition.get('fstype'):
-                        subtitle_parts.append(f"FS: {partition['fstype']}")
-                    if partition.get('label'):
-                        subtitle_parts.append(f"Label: {partition['label']}")
-                    if partition.get('mountpoint'):
-                        subtitle_parts.append(f"Mounted: {partition['mountpoint']}")
-                    
-                    if subtitle_parts:
-                        part_row.set_subtitle(" • ".join(subtitle_parts))
-                    else:
-                        part_row.set_subtitle(partition['device'])
-                    
-                    # Add bootable indicator
-                    if partition.get('bootable', False):
-                        bootable_icon = Gtk.Image()
-                        bootable_icon.set_from_icon_name("emblem-ok-symbolic")
-                        bootable_icon.set_tooltip_text("Potentially bootable")
-                        part_row.add_prefix(bootable_icon)
-                    
-                    # Add radio button
-                    radio_button = Gtk.CheckButton()
-                    radio_button.set_group(getattr(self, '_partition_group', None))
-                    if not hasattr(self, '_partition_group'):
-                        self._partition_group = radio_button
-                    
-                    radio_button.connect('toggled', self.on_partition_selected, partition)
-                    part_row.add_suffix(radio_button)
-                    part_row.set_activatable(True)
-                    part_row.connect('activated', lambda row, rb=radio_button: rb.set_active(True))
+                items.append(PartitionItem(
+                    "No NVMe devices found",
+                    "Make sure you have NVMe storage devices installed",
+                    css_class="dim-label"
+                ))
+            else:
+                # Group partitions by device
+                for device in nvme_devices:
+                    # Add device header
+                    items.append(PartitionItem(
+                        f"🔧 {device['name']} ({device['size']})",
+                        f"Device: {device['device']}",
+                        css_class="accent"
+                    ))
                     
-                    # Style based on bootable status
-                    if partition.get('bootable', False):
-                        part_row.add_css_class("success")
-                    elif partition.get('mountpoint'):
-                        part_row.add_css_class("warning")
+                    partitions = device.get('partitions', [])
+                    if not partitions:
+                        # No partitions on this device
+                        items.append(PartitionItem("  └─ No partitions found", css_class="dim-label"))
+                        continue
                     
-                    self.partitions_group.add(part_row)
-            
-            # Add info about bootable partitions
-            info_row = Adw.ActionRow()
-            info_row.set_title("ℹ️ Partition Selection Tips")
-            info_row.set_subtitle(
-                "• Green partitions (✓) are detected as potentially bootable\n"
-                "• Yellow partitions are currently mounted - they will be unmounted before booting\n"
-                "• You can select any partition, but bootable ones are more likely to work"
-            )
-            info_row.add_css_class("dim-label")
-            self.partitions_group.add(info_row)
+                    # Add partitions
+                    last_idx = len(partitions) - 1
+                    for i, partition in enumerate(partitions):
+                        prefix = "  └─ " if i == last_idx else "  ├─ "
+                        
+                        # Title with partition info
+                        title = f"{prefix}{partition['name']} ({partition['size']})"
+                        
+                        # Subtitle with filesystem and mount info
+                        subtitle = " • ".join(
+                            fmt.format(value) for key, fmt in _SUB_FIELDS
+                            if (value := partition.get(key))
+                        ) or partition['device']
+                        
+                        # Style based on bootable status
+                        if partition.get('bootable', False):
+                            css_class = "success"
+                        elif partition.get('mountpoint'):
+                            css_class = "warning"
+                        else:
+                            css_class = None
+                        
+                        items.append(PartitionItem(title, subtitle, partition, css_class))
+                
+                # Add info about bootable partitions
+                items.append(PartitionItem(
+                    "ℹ️ Partition Selection Tips", _INFO_TEXT, css_class="dim-label"
+                ))
             
         except Exception as e:
             # Error loading partitions
-            error_row = Adw.ActionRow()
-            error_row.set_title("Error loading NVMe partitions")
-            error_row.set_subtitle(f"Error: {str(e)}")
-            error_row.add_css_class("error")
-            self.partitions_group.add(error_row)
+            items = [PartitionItem("Error loading NVMe partitions", f"Error: {str(e)}", css_class="error")]
+        
+        # Identical scan: leave the list (and the selection) untouched
+        snapshot = tuple(item.key for item in items)
+        old_snapshot = self._last_snapshot
+        if snapshot == old_snapshot:
+            return
+        
+        # Only replace the rows between the unchanged head and tail
+        limit = min(len(snapshot), len(old_snapshot))
+        head = 0
+        while head < limit and snapshot[head] == old_snapshot[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and snapshot[-1 - tail] == old_snapshot[-1 - tail]:
+            tail += 1
+        
+        self.partition_store.splice(head, len(old_snapshot) - head - tail, items[head:len(items) - tail])
+        self._last_snapshot = snapshot
+        
+        # The selected row may have been replaced
+        self.on_partition_selected(self.partition_selection, 0, 0)
     
-    def on_partition_selected(self, radio_button, partition):
+    @staticmethod
+    def _device_fingerprint():
+        """Cheap snapshot of NVMe topology and mounts (no subprocesses)"""
+        try:
+            controllers = tuple(sorted(os.listdir('/sys/class/nvme')))
+        except OSError:
+            controllers = ()
+        try:
+            # Lists namespaces and their partitions
+            with os.scandir('/sys/class/block') as entries:
+                block_devices = tuple(sorted(
+                    entry.name for entry in entries if entry.name.startswith('nvme')
+                ))
+        except OSError:
+            block_devices = ()
+        try:
+            # Mount changes alter what the partition list shows
+            with open('/proc/self/mounts') as f:
+                mounts = tuple(line for line in f if line.startswith('/dev/nvme'))
+        except OSError:
+            mounts = ()
+        return controllers, block_devices, mounts
+    
+    def detect_devices(self):
+        """Detect NVMe devices, reusing a recent scan if sysfs looks unchanged"""
+        cls = NVMePartitionSelectorDialog
+        fingerprint = self._device_fingerprint()
+        cache = cls._device_cache
+        if (cache is not None and cache[1] == fingerprint
+                and time.monotonic() - cache[0] < cls._device_cache_ttl):
+            self._last_fingerprint = fingerprint
+            self._last_scan = cache[2]
+            self._last_scan_ts = cache[0]
+            return cache[2]
+        
+        nvme_devices = self.nvme_handler.detect_nvme_devices()
+        scan_ts = time.monotonic()
+        cls._device_cache = (scan_ts, fingerprint, nvme_devices)
+        self._last_fingerprint = fingerprint
+        self._last_scan = nvme_devices
+        self._last_scan_ts = scan_ts
+        return nvme_devices
+    
+    def clear_device_cache(self):
+        """Force the next detection to rescan the hardware"""
+        NVMePartitionSelectorDialog._device_cache = None
+        self.nvme_handler.invalidate()
+    
+    def on_partition_selected(self, selection, position, n_items):
         """Handle partition selection"""
-        if radio_button.get_active():
-            self.selected_partition = partition
+        item = selection.get_selected_item()
+        if item is not None and item.partition is not None:
+            self.selected_partition = item.partition
             self.select_button.set_sensitive(True)
-        elif self.selected_partition == partition:
+        else:
             self.selected_partition = None
             self.select_button.set_sensitive(False)
     
     def on_refresh(self, button):
         """Handle refresh button click"""
+        # Coalesce impatient clicks into the scan already running
+        if self._scan_inflight:
+            return
+        self._scan_inflight = True
+        
         button.set_sensitive(False)
         button.set_label("Refreshing...")
         
-        # Refresh in next idle cycle
-        def do_refresh():
-            self.refresh_partitions()
-            button.set_sensitive(True)
-            button.set_label("Refresh")
+        # A recent scan of unchanged hardware: redraw it without rescanning.
+        # Older scans are always redone, since filesystem, label or size
+        # changes do not show up in the fingerprint.
+        if (self._last_scan_ts is not None
+                and time.monotonic() - self._last_scan_ts < self._device_cache_ttl
+                and self._device_fingerprint() == self._last_fingerprint):
+            GLib.idle_add(self._apply_scan_results, button, self._last_scan)
+            return
+        
+        # Otherwise rescan, bypassing both the dialog and handler caches
+        self.clear_device_cache()
+        
+        # Scan off the main loop so the dialog keeps painting
+        threading.Thread(target=self._scan_worker, args=(button,), daemon=True).start()
+    
+    def _scan_worker(self, button):
+        """Run detection in a worker thread and hand the result to the main loop"""
+        GLib.idle_add(self._apply_scan_results, button, self._scan())
+    
+    def _apply_scan_results(self, button, scan_result):
+        """Show worker scan results (runs on the main loop)"""
+        self._scan_inflight = False
+        if self._closed:
             return False
         
-        from gi.repository import GLib
-        GLib.idle_add(do_refresh)
+        self.show_partitions(scan_result)
+        button.set_sensitive(True)
+        button.set_label("Refresh")
+        return False
+    
+    def on_close_request(self, window):
+        """Stop pending scans from touching the closed dialog"""
+        self._closed = True
+        return False
     
     def on_select(self, button):
         """Handle select button click"""
         if self.selected_partition:
-            self.emit('response', 'select')
+            self._closed = True
+            if self.on_response:
+                self.on_response('select')
     
     def on_cancel(self, button):
         """Handle cancel button click"""
-        self.emit('response', 'cancel')
+        self._closed = True
+        if self.on_response:
+            self.on_response('cancel')
     
     def get_selected_partition(self):
         """Get the currently selected partition device path"""